@@ -27,7 +27,7 @@ class ModelTrainer:
         self.params = params
         self.epochs = params.epochs
         self.node_x = torch.FloatTensor(node_x).to(self.device)
-        self.adj_norm = graph_dict["adj_norm"].to(self.device).coalesce()
+        self.edge_index = graph_dict["edge_index"].to(self.device)
         self.label = label
         self.num_classes = 1
 
@@ -37,12 +37,25 @@ class ModelTrainer:
 
         # Set up the model
         self.model = GATModel(self.params.feat_cell, self.params, self.num_classes).to(self.device)
+        if self.params.compile_model and self.device.type == 'cuda' and hasattr(torch, 'compile'):
+            # The graph and input are fixed across epochs, so the compiled step can be replayed
+            self.model = torch.compile(self.model, mode='reduce-overhead', fullgraph=False)
         self.optimizer = torch.optim.Adam(
             self.model.parameters(),
             lr=self.params.gat_lr,
             weight_decay=self.params.gcn_decay
         )
 
+        # Mixed precision: bf16 where supported, otherwise fp16 with loss scaling
+        self.use_amp = self.params.mixed_precision and self.device.type == 'cuda'
+        self.amp_dtype = torch.bfloat16
+        if self.use_amp and not torch.cuda.is_bf16_supported():
+            self.amp_dtype = torch.float16
+        # Only fp16 needs loss scaling; building the scaler lazily keeps the default path working on torch < 2.3
+        self.scaler = None
+        if self.use_amp and self.amp_dtype == torch.float16:
+            self.scaler = torch.amp.GradScaler('cuda')
+
     def run_train(self):
         """Train the model."""
         self.model.train()
@@ -52,17 +65,24 @@ class ModelTrainer:
         for epoch in range(self.epochs):
             start_time = time.time()
             self.optimizer.zero_grad()
-            pred_label, de_feat, latent_z, mu, logvar = self.model(self.node_x, self.adj_norm)
-            loss_rec = reconstruction_loss(de_feat, self.node_x)
+            with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.use_amp):
+                pred_label, de_feat, latent_z, mu, logvar = self.model(self.node_x, self.edge_index)
+            # Losses are always computed in full precision
+            loss_rec = reconstruction_loss(de_feat.float(), self.node_x)
 
             if self.label is not None:
-                loss_pre = label_loss(pred_label, self.label)
+                loss_pre = label_loss(pred_label.float(), self.label)
                 loss = self.params.rec_w * loss_rec + self.params.label_w * loss_pre
             else:
                 loss = loss_rec
 
-            loss.backward()
-            self.optimizer.step()
+            if self.scaler is None:
+                loss.backward()
+                self.optimizer.step()
+            else:
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
 
             batch_time = time.time() - start_time
             left_time = batch_time * (self.epochs - epoch - 1) / 60  # in minutes
@@ -82,7 +102,9 @@ class ModelTrainer:
 
     def get_latent(self):
         """Retrieve the latent representation from the model."""
-        self.model.eval()
+        # A single inference pass does not benefit from compilation, avoid recompiling for eval mode
+        model = getattr(self.model, '_orig_mod', self.model)
+        model.eval()
         with torch.no_grad():
-            _, _, latent_z, _, _ = self.model(self.node_x, self.adj_norm)
+            _, _, latent_z, _, _ = model(self.node_x, self.edge_index)
         return latent_z.cpu().numpy()
@@ -1,3 +1,4 @@
+import os
 import sys
 import argparse
 import logging
@@ -24,6 +25,13 @@ def get_gsMap_logger(logger_name):
     handler.setFormatter(logging.Formatter(
         '[{asctime}] {levelname:.5s} | {name} - {message}', style='{'))
     logger.addHandler(handler)
+
+    # GSMAP_LOG_LEVEL (e.g. WARNING) mutes progress messages, for instance when benchmarking
+    log_level = os.environ.get('GSMAP_LOG_LEVEL', 'DEBUG').upper()
+    if isinstance(logging.getLevelName(log_level), int):
+        logger.setLevel(log_level)
+    else:
+        logger.warning(f'Invalid GSMAP_LOG_LEVEL: {log_level}, falling back to DEBUG.')
     return logger
 
 logger = get_gsMap_logger('gsMap')
@@ -69,7 +77,13 @@ def add_find_latent_representations_args(parser):
     parser.add_argument('--n_comps', type=int, default=300, help='Number of principal components for PCA.')
     parser.add_argument('--weighted_adj', action='store_true', help='Use weighted adjacency in GAT.')
     parser.add_argument('--convergence_threshold', type=float, default=1e-4, help='Threshold for convergence.')
-    parser.add_argument('--hierarchically', action='store_true', help='Enable hierarchical latent representation finding.')
+    parser.add_argument('--hierarchically', action='store_true', help='Enable hierarchical latent representation finding. With several GPUs the cell types are fit in spawned subprocesses, so calling scripts need an if __name__ == "__main__" guard.')
+    parser.add_argument('--sparse_pca', action='store_true',
+                        help='Keep sparse expression sparse and run an implicitly centered ARPACK PCA instead of densifying it.')
+    parser.add_argument('--mixed_precision', action='store_true', help='Train the GAT model with bf16/fp16 mixed precision on GPU.')
+    parser.add_argument('--compile_model', action='store_true', help='Compile the GAT model with torch.compile on GPU.')
+    parser.add_argument('--cache_preprocessing', action='store_true',
+                        help='Cache HVGs, PCA and the spatial graph next to the output and reuse them on reruns with the same input.')
 
 
 def chrom_choice(value):
@@ -384,6 +398,10 @@ class FindLatentRepresentationsConfig(ConfigWithAutoPaths):
     var: bool = False
     convergence_threshold: float = 1e-4
     hierarchically: bool = False
+    sparse_pca: bool = False
+    mixed_precision: bool = False
+    compile_model: bool = False
+    cache_preprocessing: bool = False
 
     def __post_init__(self):
         # self.output_hdf5_path = self.hdf5_with_latent_path
@@ -1,16 +1,34 @@
+import copy
+import hashlib
+import itertools
 import logging
+import multiprocessing
+import os
 import random
+import tempfile
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
 import numpy as np
+import pandas as pd
 import scanpy as sc
+import sklearn
 import torch
+from scipy import sparse
 from sklearn.decomposition import PCA
-from sklearn.preprocessing import LabelEncoder
+from gsMap import __version__
 from gsMap.GNN.adjacency_matrix import construct_adjacency_matrix
 from gsMap.GNN.train import ModelTrainer
 from gsMap.config import FindLatentRepresentationsConfig
 
 logger = logging.getLogger(__name__)
 
+SEED = 2024
+
+# Columns written to adata.var by sc.pp.highly_variable_genes (seurat_v3 and seurat flavors)
+HVG_COLUMNS = ['highly_variable', 'highly_variable_rank', 'means', 'variances', 'variances_norm',
+               'dispersions', 'dispersions_norm']
+
 
 def set_seed(seed_value):
     """
@@ -26,9 +44,9 @@ def set_seed(seed_value):
     else:
         logger.info('Using CPU for computations.')
 
-def preprocess_data(adata, params):
+def preprocess_data(adata, params, hvg_stats=None):
     """
-    Preprocess the AnnData
+    Preprocess the AnnData, reusing the HVG columns of a previous run if given
     """
     logger.info('Preprocessing data...')
     adata.var_names_make_unique()
@@ -36,35 +54,142 @@ def preprocess_data(adata, params):
     if params.data_layer in adata.layers.keys():
         logger.info(f'Using data layer: {params.data_layer}...')
         adata.X = adata.layers[params.data_layer]
+        # Normalization, log1p and scaling are memory bound, run them in single precision
+        if adata.X.dtype != np.float32:
+            adata.X = adata.X.astype(np.float32)
         sc.pp.filter_genes(adata, min_cells=30)
     else:
         raise ValueError(f'Invalid data layer: {params.data_layer}, please check the input data.')
 
     if params.data_layer in ['count', 'counts']:
         # HVGs based on count
-        sc.pp.highly_variable_genes(adata,flavor="seurat_v3",n_top_genes=params.feat_cell)
+        if hvg_stats is None:
+            sc.pp.highly_variable_genes(adata,flavor="seurat_v3",n_top_genes=params.feat_cell)
         # Normalize the data
         sc.pp.normalize_total(adata, target_sum=1e4)
         sc.pp.log1p(adata)
 
-    elif params.data_layer in adata.layers.keys():
+    elif hvg_stats is None:
         sc.pp.highly_variable_genes(adata,flavor="seurat",n_top_genes=params.feat_cell)
 
+    if hvg_stats is not None:
+        for column in hvg_stats:
+            adata.var[column] = hvg_stats[column].to_numpy()
+
     return adata
 
 
+def get_cache_path(args: FindLatentRepresentationsConfig):
+    """
+    Path of the cached HVGs, PCA and spatial graph for this input, these parameters and these library versions.
+    """
+    input_path = Path(args.input_hdf5_path).resolve()
+    input_stat = input_path.stat()
+    key = hashlib.blake2b(
+        f'{__version__}:{sc.__version__}:{sklearn.__version__}:'
+        f'{input_path}:{input_stat.st_size}:{input_stat.st_mtime_ns}:{args.annotation}:{args.data_layer}:'
+        f'{args.feat_cell}:{args.n_comps}:{args.n_neighbors}:{args.input_pca}:{args.sparse_pca}'.encode()
+    ).hexdigest()[:16]
+    return Path(args.hdf5_with_latent_path).parent / f'.cache_{key}.npz'
+
+
+def load_cache(cache_path):
+    """
+    Load the cached artifacts of a previous run, or None if there is no usable cache.
+    """
+    if not cache_path.exists():
+        return None
+    try:
+        with np.load(cache_path) as cache_file:
+            cache = dict(cache_file)
+        hvg_stats = pd.DataFrame({key[len('var_'):]: value for key, value in cache.items() if key.startswith('var_')})
+        return hvg_stats, cache['latent_pca'], cache['edge_index']
+    except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        logger.warning(f'Ignoring unreadable cache {cache_path}: {e}')
+        return None
+
+
+def save_cache(cache_path, hvg_stats, latent_pca, edge_index):
+    """
+    Save the artifacts of this run, replacing the cache file only once it is completely written.
+    """
+    arrays = {f'var_{column}': hvg_stats[column].to_numpy() for column in hvg_stats}
+    with tempfile.NamedTemporaryFile(dir=cache_path.parent, prefix=cache_path.name, suffix='.tmp',
+                                     delete=False) as tmp_file:
+        try:
+            np.savez(tmp_file, latent_pca=latent_pca, edge_index=edge_index, **arrays)
+        except BaseException:
+            tmp_file.close()
+            os.remove(tmp_file.name)
+            raise
+    os.replace(tmp_file.name, cache_path)
+
+
+def scale_sparse(X, max_value=10):
+    """
+    Scale genes of a sparse matrix to unit variance, keeping it sparse.
+    Centering is left to the PCA. Values are clipped at max_value after (implicit) centering, but unlike
+    sc.pp.scale in scanpy >= 1.10 they are not clipped at -max_value, since zeros cannot be clipped in place.
+    """
+    X = sparse.csr_matrix(X, dtype=np.float32)
+    # Accumulate the moments in float64, as scanpy does, to avoid cancellation in E[x^2] - E[x]^2
+    X_64 = X.astype(np.float64)
+    mean = np.asarray(X_64.mean(axis=0)).ravel()
+    mean_sq = np.asarray(X_64.multiply(X_64).mean(axis=0)).ravel()
+    del X_64
+    # Unbiased variance, as in sc.pp.scale
+    std = np.sqrt(np.maximum(mean_sq - mean ** 2, 0) * X.shape[0] / (X.shape[0] - 1))
+    std[std == 0] = 1
+
+    X = X @ sparse.diags((1 / std).astype(np.float32))
+    np.minimum(X.data, (mean / std + max_value).astype(np.float32)[X.indices], out=X.data)
+    return X
+
+
 class LatentRepresentationFinder:
-    def __init__(self, adata, args: FindLatentRepresentationsConfig):
+    def __init__(self, adata, args: FindLatentRepresentationsConfig, hvg_expression=None, latent_pca=None, n_jobs=-1):
+        self.adata = adata
         self.params = args
+        self.n_jobs = n_jobs
+        self.latent_pca = latent_pca
+        self.graph_dict = None
 
-        self.expression_array = adata[:, adata.var.highly_variable].X.copy()
-        self.expression_array = sc.pp.scale(self.expression_array, max_value=10)
+        if latent_pca is not None and self.params.input_pca:
+            # The given PCA is the GNN input, so the scaled expression is never needed
+            self.expression_array = None
+            return
 
-        # Construct the neighboring graph
-        self.graph_dict = construct_adjacency_matrix(adata, self.params)
+        hvg_expression_given = hvg_expression is not None
+        if not hvg_expression_given:
+            # Index the HVG columns of the matrix directly; this already yields a new
+            # array, so neither an AnnData view nor an extra copy is needed
+            hvg_expression = adata.X[:, adata.var.highly_variable.values]
+        self.expression_array = hvg_expression
+        if sparse.issparse(self.expression_array) and self.params.input_pca and self.params.sparse_pca:
+            # Keep the matrix sparse, only the PCA output needs to be dense
+            self.expression_array = scale_sparse(self.expression_array, max_value=10)
+        elif sparse.issparse(self.expression_array):
+            self.expression_array = sc.pp.scale(self.expression_array.toarray(), max_value=10)
+        else:
+            # A dense matrix passed in by the caller is scaled on a copy, so it can be reused
+            self.expression_array = sc.pp.scale(self.expression_array, max_value=10, copy=hvg_expression_given)
+        # Single precision halves the memory traffic of the SVD and the GNN input
+        self.expression_array = self.expression_array.astype(np.float32, copy=False)
 
     def compute_pca(self):
-        self.latent_pca = PCA(n_components=self.params.n_comps).fit_transform(self.expression_array)
+        # The PCA may already have been computed as the GNN input
+        if self.latent_pca is not None:
+            return self.latent_pca
+
+        # Small cell-type subsets may have fewer cells than the requested components
+        n_comps = min(self.params.n_comps, min(self.expression_array.shape) - 1)
+        if sparse.issparse(self.expression_array):
+            # Centers implicitly, without densifying the matrix
+            self.latent_pca = sc.pp.pca(self.expression_array, n_comps=n_comps, zero_center=True, svd_solver='arpack',
+                                        random_state=SEED)
+        else:
+            # Randomized SVD only solves for the leading n_comps components
+            self.latent_pca = PCA(n_components=n_comps, svd_solver='randomized', random_state=SEED).fit_transform(self.expression_array)
         return self.latent_pca
 
     def run_gnn_vae(self, label, verbose='whole ST data'):
@@ -75,52 +200,174 @@ class LatentRepresentationFinder:
         else:
             node_X = self.expression_array
 
-        # Update the input shape
-        self.params.n_nodes = node_X.shape[0]
-        self.params.feat_cell = node_X.shape[1]
+        # Update the input shape on a copy, so the shared config stays intact across sub-fits
+        params = copy.copy(self.params)
+        params.n_nodes = node_X.shape[0]
+        params.feat_cell = node_X.shape[1]
 
-        # Run GNN
+        # Construct the neighboring graph, only needed when the GNN is trained
+        if self.graph_dict is None:
+            self.graph_dict = construct_adjacency_matrix(self.adata, self.params, n_jobs=self.n_jobs)
+
+        # Run GNN, reseeding so every fit starts from the same state regardless of fit order
         logger.info(f'Finding latent representations for {verbose}...')
-        gvae = ModelTrainer(node_X, self.graph_dict, self.params, label)
+        torch.manual_seed(SEED)
+        gvae = ModelTrainer(node_X, self.graph_dict, params, label)
         gvae.run_train()
 
-        del self.graph_dict
-
         return gvae.get_latent()
 
 
+def find_latent_representation_part(adata_part, args: FindLatentRepresentationsConfig, hvg_expression, cell_type,
+                                    n_jobs=-1):
+    """
+    Find the latent representations within a single cell type.
+    """
+    logger.info(f'{cell_type}: {adata_part.n_obs} cells.')
+
+    latent_rep_part = LatentRepresentationFinder(adata_part, args, hvg_expression, n_jobs=n_jobs)
+    if adata_part.n_obs <= args.n_comps:
+        # Too few cells to train the GNN, fall back to the leading PCs
+        latent_pca_part = latent_rep_part.compute_pca()
+        latent_gvae_part = latent_pca_part[:, :args.gat_hidden2]
+    else:
+        latent_gvae_part = latent_rep_part.run_gnn_vae(label=None, verbose=cell_type)
+        latent_pca_part = latent_rep_part.compute_pca()
+
+    return latent_gvae_part, latent_pca_part
+
+
+def init_gpu_worker(gpu_queue, n_threads):
+    """
+    Pin a worker process to its own GPU and its share of the CPU threads.
+    """
+    torch.cuda.set_device(gpu_queue.get())
+    torch.set_num_threads(n_threads)
+
+
 def run_find_latent_representation(args: FindLatentRepresentationsConfig):
-    set_seed(2024)
+    set_seed(SEED)
 
     # Load the ST data
     logger.info(f'Loading ST data of {args.sample_name}...')
-    adata = sc.read_h5ad(args.input_hdf5_path)
-    logger.info(f'The ST data contains {adata.shape[0]} cells, {adata.shape[1]} genes.')
+    # Open in backed mode, so X is only loaded for the cells kept below (layers are read in full regardless)
+    adata_backed = sc.read_h5ad(args.input_hdf5_path, backed='r')
+    logger.info(f'The ST data contains {adata_backed.shape[0]} cells, {adata_backed.shape[1]} genes.')
 
     # Load the cell type annotation
     if args.annotation is not None:
-        # Remove cells without enough annotations
-        adata = adata[~adata.obs[args.annotation].isnull()]
-        num = adata.obs[args.annotation].value_counts()
-        valid_annotations = num[num >= 30].index.to_list()
-        adata = adata[adata.obs[args.annotation].isin(valid_annotations)]
-
-        le = LabelEncoder()
-        label =  le.fit_transform(adata.obs[args.annotation])
+        # Remove cells without enough annotations and encode the rest in one pass
+        annotation = pd.Categorical(adata_backed.obs[args.annotation])
+        codes = annotation.codes.astype(np.int64)
+        annotated = codes >= 0
+        valid_annotations = np.bincount(codes[annotated], minlength=len(annotation.categories)) >= 30
+
+        keep = annotated & valid_annotations[codes]
+        adata = adata_backed[keep].to_memory()
+
+        # Renumber the remaining annotations to consecutive integer labels
+        label = (np.cumsum(valid_annotations) - 1)[codes[keep]]
     else:
         label = None
+        adata = adata_backed.to_memory()
+    adata_backed.file.close()
+
+    # Optionally reuse the deterministic artifacts of a previous run on the same input, e.g. when tuning the GNN
+    cache = None
+    if args.cache_preprocessing:
+        cache_path = get_cache_path(args)
+        cache = load_cache(cache_path)
+        if cache is not None:
+            logger.info(f'Loaded cached HVGs, PCA and spatial graph from {cache_path}.')
 
-    # Preprocess data
-    adata = preprocess_data(adata, args)
+    if cache is None:
+        adata = preprocess_data(adata, args)
+    else:
+        hvg_stats, cached_latent_pca, cached_edge_index = cache
+        adata = preprocess_data(adata, args, hvg_stats)
+
+    # Slice the HVG columns once, the whole-data fit and the hierarchical sub-fits share them
+    hvg_expression = adata.X[:, adata.var.highly_variable.values]
+    if cache is None:
+        latent_rep = LatentRepresentationFinder(adata, args, hvg_expression)
+    else:
+        latent_rep = LatentRepresentationFinder(adata, args, hvg_expression, latent_pca=cached_latent_pca)
+        latent_rep.graph_dict = {'edge_index': torch.from_numpy(cached_edge_index)}
+    if not args.hierarchically:
+        del hvg_expression
 
-    latent_rep = LatentRepresentationFinder(adata, args)
     latent_gvae = latent_rep.run_gnn_vae(label)
-    latent_pca = latent_rep.latent_pca
+    latent_pca = latent_rep.compute_pca()
+
+    if args.cache_preprocessing and cache is None:
+        hvg_stats = adata.var[[column for column in adata.var if column in HVG_COLUMNS]]
+        save_cache(cache_path, hvg_stats, latent_pca, latent_rep.graph_dict['edge_index'].numpy())
 
     # Add latent representations to the AnnData object
     logger.info('Adding latent representations...')
     adata.obsm["latent_GVAE"] = latent_gvae
     adata.obsm["latent_PCA"] = latent_pca
+    # Release the scaled expression and graph of the whole-data fit before any sub-fits
+    del latent_rep
+
+    # Find latent representations hierarchically (optionally)
+    if args.hierarchically:
+        logger.info('Finding latent representations hierarchically...')
+        # Row positions of each cell type, computed in a single pass over the annotation
+        cell_type_indices = adata.obs.groupby(args.annotation, observed=True).indices
+
+        # Missing components of small cell types are left as zeros
+        latent_gvae_hierarchy = np.zeros((adata.n_obs, args.gat_hidden2), dtype=np.float32)
+        latent_pca_hierarchy = np.zeros((adata.n_obs, args.n_comps), dtype=np.float32)
+        spatial = np.asarray(adata.obsm['spatial'])
+
+        def make_part(idx):
+            # Only what a sub-fit reads, so it is cheap to send to a worker process
+            adata_part = sc.AnnData(obs=pd.DataFrame(index=adata.obs_names[idx]), obsm={'spatial': spatial[idx]})
+            return adata_part, hvg_expression[idx]
+
+        def store_part(ct, latent_gvae_part, latent_pca_part):
+            idx = cell_type_indices[ct]
+            latent_gvae_hierarchy[idx, :latent_gvae_part.shape[1]] = latent_gvae_part
+            latent_pca_hierarchy[idx, :latent_pca_part.shape[1]] = latent_pca_part
+
+        n_gpus = torch.cuda.device_count()
+        if n_gpus > 1:
+            # The cell types are independent, fit them concurrently with one worker per GPU.
+            # CUDA requires spawned workers, so scripts calling this need an `if __name__ == '__main__':` guard
+            logger.info(f'Fitting {len(cell_type_indices)} cell types on {n_gpus} GPUs in spawned subprocesses...')
+            mp_context = multiprocessing.get_context('spawn')
+            gpu_queue = mp_context.Queue()
+            for gpu_id in range(n_gpus):
+                gpu_queue.put(gpu_id)
+            # Split the CPU threads between the workers instead of letting each use all of them
+            n_jobs = max(1, (os.cpu_count() or 1) // n_gpus)
+
+            with ProcessPoolExecutor(max_workers=n_gpus, mp_context=mp_context,
+                                     initializer=init_gpu_worker, initargs=(gpu_queue, n_jobs)) as executor:
+                def submit_parts(n_parts):
+                    for ct, idx in itertools.islice(remaining, n_parts):
+                        adata_part, hvg_part = make_part(idx)
+                        future = executor.submit(find_latent_representation_part, adata_part, args, hvg_part, ct,
+                                                 n_jobs=n_jobs)
+                        futures[future] = ct
+
+                # Keep one part per worker in flight, so payloads are only sliced when a GPU frees up
+                remaining = iter(cell_type_indices.items())
+                futures = {}
+                submit_parts(n_gpus)
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        store_part(futures.pop(future), *future.result())
+                    submit_parts(len(done))
+        else:
+            for ct, idx in cell_type_indices.items():
+                adata_part, hvg_part = make_part(idx)
+                store_part(ct, *find_latent_representation_part(adata_part, args, hvg_part, ct))
+
+        adata.obsm["latent_GVAE_hierarchy"] = latent_gvae_hierarchy
+        adata.obsm["latent_PCA_hierarchy"] = latent_pca_hierarchy
 
     # Run UMAP based on latent representations
     #for name in ['latent_GVAE', 'latent_PCA']: